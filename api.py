@@ -8,17 +8,26 @@ to and from users.
 """
 
 # Imports and Setup
+import random
+
 import endpoints
 from protorpc import remote, messages, message_types
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
 
-from models import User, UserForm, UserForms
-from models import Game, NewGameForm, GameForm
+from models import User, UserForm
+from models import Game, NewGameForm, GameForm, StaleGameError
+from models import NewGamesForm, GameForms
 from models import MiniGameForms, HistoryForm
 from models import CardForm, MakeGuessForm, HintForm
-from models import Score, ScoreForms
+from models import Score, ScoreForms, Leaderboard
+from models import Rankings, RankingsForm, UserCounterShard
 from models import StringMessage
-from utils import get_by_urlsafe
+from models import to_forms
+from utils import get_by_urlsafe, get_key_by_urlsafe
+from utils import fetch_page, fetch_page_async
+from ratelimit import enforce, rate_limited
+from metrics import instrumented
 
 # UNCOMMENT THE LINES 25-27 FOR APP ENGINE DEPLOY IF SETTINGS.PY IS PRESENT,
 # ALSO UNCOMMENT THE allowed_client_ids AND scopes FROM API SETUP (LINE 59-60)
@@ -32,9 +41,21 @@ import game as gm
 # Various Request Containers
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
+
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1))
 
+SHOW_GAME_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        encoding=messages.StringField(2))
+
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        offset=messages.IntegerField(2, default=0),
+        limit=messages.IntegerField(3, default=50),
+        summary=messages.BooleanField(4, default=False))
+
 FLIP_CARD_REQUEST = endpoints.ResourceContainer(
         queryCard=messages.IntegerField(1),
         urlsafe_game_key=messages.StringField(2))
@@ -50,8 +71,81 @@ USER_REQUEST = endpoints.ResourceContainer(
 USER_INFO_REQUEST = endpoints.ResourceContainer(
         user_name=messages.StringField(1))
 
+PAGE_REQUEST = endpoints.ResourceContainer(
+        limit=messages.IntegerField(1),
+        cursor=messages.StringField(2))
+
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+        page=messages.IntegerField(1, default=1))
+
+USER_RANK_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        neighbors=messages.IntegerField(2, default=2))
+
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        limit=messages.IntegerField(2),
+        cursor=messages.StringField(3))
+
 MEMCACHE_HIGH_SCORE = 'TOP_SCORE'
 
+# Properties projected by the game listings, so that they never load the
+# board or move log. Listings filtered on status project only the counters.
+MINI_GAME_PROJECTION = [Game.guesses, Game.cards, Game.status]
+ACTIVE_GAME_PROJECTION = [Game.guesses, Game.cards]
+
+# Upper bound on the number of moves returned in one page of game history
+MAX_HISTORY_PAGE = 200
+
+# Attempts at saving a move while other moves on the same game are saved,
+# and the delay (in seconds) before the first retry, doubled each time
+MOVE_RETRIES = 3
+MOVE_RETRY_DELAY = 0.05
+
+# Calls allowed per game to the gameplay endpoints, as (calls, seconds)
+FLIP_CARD_LIMIT = (60, 60)
+MAKE_MOVE_LIMIT = (60, 60)
+GET_HINT_LIMIT = (10, 60)
+# Calls allowed per user to the same endpoints, across all of their games,
+# so that a client can't sidestep the limits by starting more games
+USER_FLIP_CARD_LIMIT = (180, 60)
+USER_MAKE_MOVE_LIMIT = (180, 60)
+USER_GET_HINT_LIMIT = (30, 60)
+
+# Upper bound on the number of games created by one new_games request
+MAX_BULK_GAMES = 500
+
+
+def _check_encoding(encoding):
+    """Rejects a request for an unknown board encoding"""
+    if encoding and encoding not in gm.BOARD_ENCODINGS:
+        raise endpoints.BadRequestException(
+            'encoding must be one of: {0}'.format(
+                ', '.join(gm.BOARD_ENCODINGS)))
+
+
+def _retry_delay(attempt):
+    """Returns a Future that completes after a randomized, exponentially
+    growing delay, before retrying a change to a game"""
+    delay = MOVE_RETRY_DELAY * (2 ** attempt)
+    return ndb.sleep(delay * (0.5 + random.random()))
+
+
+def _enforce_user_limit(name, game, limit):
+    """Counts a call to the named endpoint against the game's owner,
+    rejecting it if the owner is over the limit across all their games.
+    Counted by the User's key, which stays the same if they are renamed"""
+    enforce(name + ':user', game.user.id(), *limit,
+            message='Rate limit exceeded for this user, try again shortly')
+
+
+def _user_key(user_name):
+    """Returns the key of the User with the given name. Users are keyed by
+    name, so queries on a user can start before the User is fetched"""
+    if not user_name:
+        raise endpoints.NotFoundException('No such user.')
+    return ndb.Key(User, user_name)
+
 
 # ### CONCENTRATION API ###
 @endpoints.api(name='concentration',
@@ -68,15 +162,17 @@ class ConcentrationApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        # Check that the username is not in use
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException('A user name is required!')
+        # Create a new user, provided the username is not in use
+        user = User.create(request.user_name, request.email)
+        if not user:
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        # Create a new user, send a confirmation message
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        # Send a confirmation message
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -85,9 +181,10 @@ class ConcentrationApi(remote.Service):
                       path='user/info',
                       name='user_info',
                       http_method='GET')
+    @instrumented
     def user_info(self, request):
         """Get stats about a user"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         # Check that user exists
         if not user:
             raise endpoints.NotFoundException('No such user.')
@@ -95,46 +192,57 @@ class ConcentrationApi(remote.Service):
             # Return a summary form with user information
             return user.to_form()
 
-    @endpoints.method(request_message=USER_INFO_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=MiniGameForms,
                       path='user/all',
                       name='get_all_games',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_all_games(self, request):
-        """Return a list of all of a User's games"""
-        user = User.query(User.name == request.user_name).get()
+        """Return a page of all of a User's games"""
+        # Fetch a page of games, projecting only the listed properties,
+        # while checking that the user exists
+        q = Game.query(Game.user == _user_key(request.user_name))
+        user, (games, next_cursor) = yield (
+            User.get_by_name_async(request.user_name),
+            fetch_page_async(q, request, projection=MINI_GAME_PROJECTION))
         # Check that user exists
         if not user:
             raise endpoints.NotFoundException('No such user.')
         else:
-            # Fetch all games
-            q = Game.query(Game.user == user.key)
-            games = q.fetch()
             # Return a set of simplified game info forms
-            return MiniGameForms(
-                games=[g.to_mini_form() for g in games]
-            )
+            raise ndb.Return(MiniGameForms(
+                games=to_forms(games, 'to_mini_form', resolve_users=False),
+                next_cursor=next_cursor
+            ))
 
-    @endpoints.method(request_message=USER_INFO_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=MiniGameForms,
                       path='user/current',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_user_games(self, request):
-        """Return a list of all of a User's active (in-progress) games"""
-        user = User.query(User.name == request.user_name).get()
+        """Return a page of a User's active (in-progress) games"""
+        # Fetch a page of in-progress games while checking that the user
+        # exists
+        q = Game.query(Game.user == _user_key(request.user_name),
+                       Game.status == 'In Progress')
+        user, (games, next_cursor) = yield (
+            User.get_by_name_async(request.user_name),
+            fetch_page_async(q, request, projection=ACTIVE_GAME_PROJECTION))
         # Check that user exists
         if not user:
             raise endpoints.NotFoundException('No such user.')
         else:
-            # Fetch all games
-            q = Game.query(Game.user == user.key)
-            q.filter(Game.status == 'In Progress')
-            games = q.fetch()
             # Return a set of simplified game info forms
-            return MiniGameForms(
-                games=[g.to_mini_form() for g in games]
-            )
+            raise ndb.Return(MiniGameForms(
+                games=to_forms(games, 'to_mini_form', resolve_users=False,
+                               status='In Progress'),
+                next_cursor=next_cursor
+            ))
 
     # GAME METHODS
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -142,81 +250,146 @@ class ConcentrationApi(remote.Service):
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
+    @ndb.synctasklet
     def cancel_game(self, request):
         """Cancel an in-progress (but not completed) game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        # Make sure we can cancel the specified game
-        if not game:
-            raise endpoints.NotFoundException(
-              "Can't cancel! Game doesn't exist!")
-        elif game.status == 'Won':
-            raise endpoints.BadRequestException(
-              "Can't cancel a game that's been won!")
-        elif game.status == 'Canceled':
-            raise endpoints.BadRequestException(
-              "You've already cancelled that game.")
-        else:
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        # Should a move be saved meanwhile, cancel the game as it left it
+        for attempt in range(MOVE_RETRIES):
+            game, _ = yield Game.load_async(game_key)
+            # Make sure we can cancel the specified game
+            if not game:
+                raise endpoints.NotFoundException(
+                  "Can't cancel! Game doesn't exist!")
+            elif game.status == 'Won':
+                raise endpoints.BadRequestException(
+                  "Can't cancel a game that's been won!")
+            elif game.status == 'Canceled':
+                raise endpoints.BadRequestException(
+                  "You've already cancelled that game.")
             # Cancel the game and return a confirmation
+            version = game.version or 0
             game.status = 'Canceled'
-            game.put()
-            return StringMessage(message='Game canceled.')
+            try:
+                game.commit(None, version)
+                raise ndb.Return(StringMessage(message='Game canceled.'))
+            except StaleGameError:
+                yield _retry_delay(attempt)
+        raise endpoints.ConflictException(
+          'The game is being changed by another request, try again')
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
+    @ndb.synctasklet
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        _check_encoding(request.encoding)
+        # Look up the user while allocating an id for the new game
+        user, (game_id, _) = yield (
+            User.get_by_name_async(request.user_name),
+            Game.allocate_ids_async(1))
         # Make sure user exists
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         try:
-            # Create the new Game
-            game = Game.new_game(user.key, request.cards)
+            # Deal the new Game
+            game, record = Game.build(ndb.Key(Game, game_id), user,
+                                      request.cards)
         except:
             raise endpoints.BadRequestException('Request Failed')
-        # Increment total games by 1, but if it's initially zero, deal
-        # with the error that gets thrown
-        try:
-            user.total_games += 1
-        except TypeError:
-            user.total_games = 1
-        user.put()
+        # Save the game and its record while counting the user's new game
+        yield (ndb.put_multi_async([game, record]),
+               UserCounterShard.increment_async(user.key, games=1))
         # Send the new game back to the user, ready to play
-        return game.to_form('Let the Guessing Begin!')
+        raise ndb.Return(game.to_form('Let the Guessing Begin!',
+                                      request.encoding))
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented
+    def new_games(self, request):
+        """Creates games in bulk, for one or many users"""
+        # Each user is dealt their games once, however often they're listed
+        names = []
+        for name in request.user_names:
+            if name not in names:
+                names.append(name)
+        count = request.games_per_user
+        if not names or count < 1:
+            raise endpoints.BadRequestException(
+                    'At least one user and one game per user are required')
+        if len(names) * count > MAX_BULK_GAMES:
+            raise endpoints.BadRequestException(
+                    'At most {0} games can be created at once'.format(
+                        MAX_BULK_GAMES))
+        # Look all of the users up at once, moving any created before
+        # users were keyed by name, and make sure they exist
+        lookups = [User.get_by_name_async(name) for name in names]
+        users = [lookup.get_result() for lookup in lookups]
+        missing = [name for name, user in zip(names, users) if not user]
+        if missing:
+            raise endpoints.NotFoundException(
+                    u'No such user(s): {0}'.format(u', '.join(missing)))
+        try:
+            # Deal every game, and save them with the users' totals
+            games = Game.new_games(users, count, request.cards)
+        except ValueError:
+            raise endpoints.BadRequestException('Request Failed')
+        return GameForms(games=[game.to_form('Let the Guessing Begin!')
+                                for game in games])
+
+    @endpoints.method(request_message=SHOW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       http_method='GET',
                       name='show_game')
+    @instrumented
     def show_game(self, request):
         """Return the board state for the specified game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        _check_encoding(request.encoding)
+        game = get_by_urlsafe(request.urlsafe_game_key, Game, use_cache=True)
         # Check that the game exists
         if not game:
             raise endpoints.NotFoundException('No game found!')
         else:
             # Return the game information, prompting user to make a move
-            return game.to_form('Make your move!')
+            return game.to_form('Make your move!', request.encoding)
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=HistoryForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_game_history(self, request):
-        """Show the history of moves for a game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Show the history of moves for a game, one page at a time"""
+        # The summary is served from the Game alone; otherwise fetch the
+        # GameRecord alongside it
+        game, record = yield Game.load_async(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game),
+            with_record=not request.summary)
         # Check that the game exists
         if not game:
             raise endpoints.NotFoundException('No such game!')
+        elif request.offset < 0 or request.limit < 1:
+            raise endpoints.BadRequestException(
+              'offset must not be negative and limit must be positive')
         else:
-            # Return a game summary and history of moves
-            return game.to_history_form()
+            # Return a game summary and a page of the history of moves
+            raise ndb.Return(game.to_history_form(
+              record,
+              offset=request.offset,
+              limit=min(request.limit, MAX_HISTORY_PAGE)))
 
     # GAME METHODS -- CARD ACTIONS
     @endpoints.method(request_message=FLIP_CARD_REQUEST,
@@ -224,156 +397,251 @@ class ConcentrationApi(remote.Service):
                       path='game/{urlsafe_game_key}/flip',
                       http_method='GET',
                       name='flip_card')
+    @instrumented
+    @rate_limited(*FLIP_CARD_LIMIT)
+    @ndb.synctasklet
     def flip_card(self, request):
         """Responds to a guessed card by revealing a card's value"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        # Fetch the game and its board together
+        game, record = yield Game.load_async(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game),
+            with_record=True)
         # Check that the game exists
         if not game:
             raise endpoints.NotFoundException('No game found!')
-        elif game.status != 'In Progress':
+        _enforce_user_limit('flip_card', game, USER_FLIP_CARD_LIMIT)
+        if game.status != 'In Progress':
             raise endpoints.BadRequestException(
               'Not an active game, guesses no longer allowed')
+        elif record is None:
+            raise endpoints.NotFoundException('No board found for that game!')
         else:
-            # Retrieve the board and return the specified card's value
-            board = game.board
+            # Return the specified card's value
             guessedCard = getattr(request, 'queryCard')
-            result = gm.turnCard(guessedCard, board)
-            return CardForm(cardValue=result)
+            result = gm.turnCard(guessedCard, record.board)
+            raise ndb.Return(CardForm(cardValue=result))
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}/move',
                       http_method='PUT',
                       name='make_move')
+    @instrumented
+    @rate_limited(*MAKE_MOVE_LIMIT)
+    @ndb.synctasklet
     def make_move(self, request):
         """Accepts two cards and reveals whether they match"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        # Make sure the game exists and is in progress
-        if not game:
-            raise endpoints.NotFoundException('No game found!')
-        elif game.status != 'In Progress':
+        _check_encoding(request.encoding)
+        # Retrieve the played cards
+        card1 = getattr(request, 'card1')
+        card2 = getattr(request, 'card2')
+        if card1 == card2:
+            # The user is guessing the same card twice
             raise endpoints.BadRequestException(
-              'Not an active game, moves no longer allowed')
-        else:
-            # Retrieve the board and played cards
-            board = game.board
-            displayBoard = game.boardState
-            card1 = getattr(request, 'card1')
-            card2 = getattr(request, 'card2')
-            if card1 == card2:
-                # The user is guessing the same card twice
+              "You can't pick the same card twice!")
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        # Should another move be saved while this one is played, play it
+        # again against the game as that move left it
+        for attempt in range(MOVE_RETRIES):
+            # Fetch the game and its record together
+            game, record = yield Game.load_async(game_key, with_record=True)
+            # Make sure the game exists and is in progress
+            if not game:
+                raise endpoints.NotFoundException('No game found!')
+            if attempt == 0:
+                # Retries are the same call, so count it once
+                _enforce_user_limit('make_move', game, USER_MAKE_MOVE_LIMIT)
+            if game.status != 'In Progress':
+                raise endpoints.BadRequestException(
+                  'Not an active game, moves no longer allowed')
+            elif record is None:
+                raise endpoints.NotFoundException(
+                  'No board found for that game!')
+            elif not (0 <= card1 < game.cards and 0 <= card2 < game.cards):
+                # Checked before the move changes the game at all
                 raise endpoints.BadRequestException(
-                  "You can't pick the same card twice!")
-            else:
-                # Evaluate the result of the move and update game information
-                message, resultBoard = gm.compareCards(
-                  card1, card2, board, displayBoard)
-                game.guesses += 1
-                game.boardState = resultBoard
-                # Check to see if the game has now been won
-                if gm.isGameWon(game.boardState):
-                    message += ' Congratulations - You win! All cards matched!'
-                    game.status = 'Won'
-                    game.win_game()
-
-                # Append the current move to the game history
-                game.history.append(
-                  'guess: {0} result: {1}'.format([card1, card2], message))
-                game.put()
-                return game.to_form(message=message)
+                  'Cards are numbered from 0 to {0}'.format(game.cards - 1))
+            version = game.version or 0
+            # Evaluate the result of the move, updating the game
+            # information and appending the move to the game's log
+            message = game.play_move(record, card1, card2)
+            try:
+                # Saves the game, along with the score and user totals if
+                # the move won it
+                game.commit(record, version)
+                break
+            except StaleGameError:
+                # Give the other move time to be saved before reloading
+                yield _retry_delay(attempt)
+        else:
+            raise endpoints.ConflictException(
+              'The game is being changed by another request, try again')
+        # Check to see if the game has now been won
+        if game.status == 'Won':
+            message += gm.WIN_MESSAGE
+        # The client is in sync if its board reflects the version of the
+        # game the move was played against
+        if request.version is not None and request.version == version:
+            # Send only what the move changed
+            raise ndb.Return(game.to_delta_form(
+                message, record, card1, card2))
+        raise ndb.Return(game.to_form(message, request.encoding))
 
     @endpoints.method(request_message=FLIP_CARD_REQUEST,
                       response_message=HintForm,
                       path='game/{urlsafe_game_key}/hint',
                       http_method='GET',
                       name='get_hint')
+    @instrumented
+    @rate_limited(*GET_HINT_LIMIT)
+    @ndb.synctasklet
     def get_hint(self, request):
         """Gives a hint for a card that matches a selected card"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        # Fetch the game and its board together
+        game, record = yield Game.load_async(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game),
+            with_record=True)
         # Check that the game exists:
         if not game:
             raise endpoints.NotFoundException('No game found!')
-        elif game.status != 'In Progress':
+        _enforce_user_limit('get_hint', game, USER_GET_HINT_LIMIT)
+        if game.status != 'In Progress':
             raise endpoints.BadRequestException(
               'Not an active game, no hints or moves permitted')
+        elif record is None:
+            raise endpoints.NotFoundException('No board found for that game!')
         else:
             # Get the card and generate a hint
             selectedCard = getattr(request, 'queryCard')
-            hint = gm.giveHint(selectedCard, game.board)
-            return HintForm(hint=hint)
+            hint = gm.giveHint(selectedCard, record.board)
+            raise ndb.Return(HintForm(hint=hint))
 
     # SCORE METHODS
-    @endpoints.method(request_message=message_types.VoidMessage,
+    @endpoints.method(request_message=PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of all scores"""
+        scores, next_cursor = fetch_page(Score.query(), request)
+        return ScoreForms(items=to_forms(scores), next_cursor=next_cursor)
 
-    @endpoints.method(request_message=USER_INFO_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
+    @ndb.synctasklet
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's scores"""
+        # Retrieve a page of relevant scores while checking that the user
+        # exists
+        q = Score.query(Score.user == _user_key(request.user_name))
+        user, (scores, next_cursor) = yield (
+            User.get_by_name_async(request.user_name),
+            fetch_page_async(q, request))
         # Make sure user exists
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        # Retrieve and return all relevant scores
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        raise ndb.Return(ScoreForms(items=to_forms(scores),
+                                    next_cursor=next_cursor))
 
     @endpoints.method(request_message=message_types.VoidMessage,
                       response_message=ScoreForms,
                       path='scores/high',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
         """Generate a list of high scores"""
-        q = Score.query().order(-Score.score)
-        # Just take the top ten scores
-        q.fetch(10)
-        return ScoreForms(items=[score.to_form() for score in q])
+        # The top ten scores are kept up to date in the leaderboard
+        return ScoreForms(items=to_forms(Leaderboard.load().entries))
 
-    @endpoints.method(request_message=message_types.VoidMessage,
-                      response_message=UserForms,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=RankingsForm,
                       path='users/rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-        """Return the players, ranked by average score"""
-        q = User.query().order(-User.avg_score)
-        # Return all players, ranked
-        q.fetch()
-        return UserForms(users=[user.to_form() for user in q])
+        """Return a page of the players, ranked by average score"""
+        rankings = Rankings.load()
+        # Make sure the page exists
+        if request.page < 1 or request.page > len(rankings.page_sizes):
+            raise endpoints.NotFoundException('No such page.')
+        # Return one page of players from the rankings snapshot
+        return rankings.to_form(rankings.get_page(request.page),
+                                request.page)
+
+    @endpoints.method(request_message=USER_RANK_REQUEST,
+                      response_message=RankingsForm,
+                      path='users/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Return a player's rank, along with the players ranked either
+        side of them"""
+        user = User.get_by_name(request.user_name)
+        # Check that user exists
+        if not user:
+            raise endpoints.NotFoundException('No such user.')
+        rankings = Rankings.load()
+        found = rankings.find(user.name)
+        # Check that the user is in the snapshot yet
+        if not found:
+            raise endpoints.NotFoundException(
+                    'That user has not been ranked yet.')
+        page, rank = found
+        neighbors = min(max(request.neighbors, 0), 10)
+        return rankings.to_form(rankings.neighbors(page, rank, neighbors),
+                                page)
 
     @endpoints.method(request_message=message_types.VoidMessage,
                       response_message=StringMessage,
                       path='/scores/top',
                       name='get_top_score',
                       http_method='GET')
+    @instrumented
     def get_top_score(self, request):
         """Get the cached highest score"""
-        return StringMessage(message=memcache.get(MEMCACHE_HIGH_SCORE) or '')
+        cached = memcache.get(MEMCACHE_HIGH_SCORE)
+        if cached is None:
+            # Fall back to rebuilding the announcement
+            return StringMessage(message=ConcentrationApi._cache_high_score())
+        return StringMessage(message=cached['message'])
 
     @staticmethod
     def _cache_high_score():
-        """Populates memcache with a high score announcement"""
-        q = Score.query().order(-Score.score)
-        q.get()
-        if q:
+        """Populates memcache with a high score announcement, taken from
+        the leaderboard, and returns it. The cached entry carries the
+        leaderboard's version, so an older announcement never replaces a
+        newer one"""
+        board = Leaderboard.load()
+        message = ''
+        if board.entries:
             # Retrieve the high score information, if available
-            user = q.user_name
-            score = q.score
-            date = q.date
-            memcache.set(MEMCACHE_HIGH_SCORE,
-                         '''Congratulations to {0}, with the high score
-                         of {1}, set on {2}!'''.format(user, score, date))
+            top = board.entries[0]
+            message = (u'Congratulations to {0}, with the high score '
+                       u'of {1}, set on {2}!'.format(top.user_name, top.score,
+                                                    top.date))
+        entry = {'version': board.version, 'message': message}
+        client = memcache.Client()
+        for _ in range(3):
+            cached = client.gets(MEMCACHE_HIGH_SCORE)
+            if cached is None:
+                if client.add(MEMCACHE_HIGH_SCORE, entry):
+                    break
+            elif cached['version'] >= board.version:
+                # Already up to date (or newer)
+                return cached['message']
+            elif client.cas(MEMCACHE_HIGH_SCORE, entry):
+                break
+        return message
 
 
 api = endpoints.api_server([ConcentrationApi])
@@ -0,0 +1,269 @@
+"""cache.py - Write-through caching of entities on the game's hot path.
+
+Entities are cached by urlsafe key in memcache and in a small in-process
+LRU. Memcache holds a 'head' entry with the latest cached version of an
+entity, and the serialized entity itself under a versioned key, so that a
+reader never sees a head pointing at an older payload and a slow writer
+can't overwrite a newer version with an older one.
+
+Lookups of keys that don't exist are remembered for a short while too, so
+that repeated requests for unknown users or games don't each reach the
+datastore.
+
+Writers can also claim the next version of an entity before writing it.
+A 'claim' entry holds the latest version written, and the claim on each
+next version is a short-lived entry that only one writer can add. Of
+several writers starting from the same version, only one can claim the
+next, without any datastore locking; a claim whose writer dies expires
+within seconds. Each claimed version is also remembered for as long as
+cached entries last, so that once a claim has lapsed without the version
+being confirmed as written, later writers of that version check the
+datastore instead."""
+
+import threading
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+NAMESPACE = 'entity-cache'
+# Seconds before cached entries expire from memcache
+EXPIRY = 60 * 60
+# Number of attempts to advance the head entry before giving up
+CAS_RETRIES = 3
+# Seconds to remember that a key doesn't exist
+MISSING_EXPIRY = 30
+# Seconds before an unreleased claim on a version expires
+CLAIM_EXPIRY = 10
+
+
+class LRU(object):
+    """A small, thread-safe, least-recently-used mapping"""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+
+_local = LRU(500)
+
+
+def _encode(entity):
+    return ndb.model_to_protobuf(entity).Encode()
+
+
+def _decode(data):
+    return ndb.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+def _payload_key(cache_key, version):
+    return '{0}:{1}'.format(cache_key, version)
+
+
+def _missing_key(cache_key):
+    return 'missing:{0}'.format(cache_key)
+
+
+def _claim_key(cache_key):
+    return 'claim:{0}'.format(cache_key)
+
+
+def _version_claim_key(cache_key, version):
+    return 'claim:{0}:{1}'.format(cache_key, version)
+
+
+def _claimed_key(cache_key, version):
+    return 'claimed:{0}:{1}'.format(cache_key, version)
+
+
+def _advance(client, cache_key, version):
+    """Raises the version held in a memcache entry to version. Returns
+    False if the entry already held that version or a later one, or if
+    other writers kept it from being advanced"""
+    for _ in range(CAS_RETRIES):
+        current = client.gets(cache_key, namespace=NAMESPACE)
+        if current is None:
+            if client.add(cache_key, version, time=EXPIRY,
+                          namespace=NAMESPACE):
+                break
+        elif current >= version:
+            return False
+        elif client.cas(cache_key, version, time=EXPIRY,
+                        namespace=NAMESPACE):
+            break
+    else:
+        return False
+    return True
+
+
+@ndb.tasklet
+def get_async(key):
+    """Returns the entity for an ndb key, from the in-process LRU if it
+    holds the latest version, else from memcache, else from the datastore
+    (caching what it finds). Returns None if there is no such entity.
+    Concurrent calls have their memcache lookups batched by ndb."""
+    ctx = ndb.get_context()
+    cache_key = key.urlsafe()
+    # Fetch the head and any record of the key being missing together
+    version, missing = yield (
+        ctx.memcache_get(cache_key, namespace=NAMESPACE),
+        ctx.memcache_get(_missing_key(cache_key), namespace=NAMESPACE))
+    if version is None and missing is not None:
+        raise ndb.Return(None)
+    if version is not None:
+        hit = _local.get(cache_key)
+        if hit and hit[0] == version:
+            raise ndb.Return(_decode(hit[1]))
+        data = yield ctx.memcache_get(_payload_key(cache_key, version),
+                                      namespace=NAMESPACE)
+        if data is not None:
+            _local.put(cache_key, (version, data))
+            raise ndb.Return(_decode(data))
+    # Skip ndb's in-context cache, which may hold an instance the caller
+    # has since modified without saving
+    entity = yield key.get_async(use_cache=False)
+    if entity is not None:
+        store(entity)
+    else:
+        mark_missing(key)
+    raise ndb.Return(entity)
+
+
+def get(key):
+    """Synchronous version of get_async"""
+    return get_async(key).get_result()
+
+
+def store(entity):
+    """Writes an entity through to the cache, unless a newer version of
+    it is already cached"""
+    cache_key = entity.key.urlsafe()
+    version = entity.version
+    data = _encode(entity)
+    client = memcache.Client()
+    # Write the payload before advancing the head, so that the head never
+    # points at a payload that isn't there
+    client.set(_payload_key(cache_key, version), data, time=EXPIRY,
+               namespace=NAMESPACE)
+    if not _advance(client, cache_key, version):
+        # A newer (or the same) version is already cached
+        return
+    _local.put(cache_key, (version, data))
+
+
+def store_created(entities):
+    """Writes newly created entities through to the cache with a few
+    batched calls, rather than several calls each as store makes. No
+    other version of them can be cached yet, so their heads are simply
+    added. They are left out of the in-process LRU, which a large batch
+    would only flush"""
+    payloads, heads = {}, {}
+    for entity in entities:
+        cache_key = entity.key.urlsafe()
+        payloads[_payload_key(cache_key, entity.version)] = _encode(entity)
+        heads[cache_key] = entity.version
+    client = memcache.Client()
+    client.set_multi(payloads, time=EXPIRY, namespace=NAMESPACE)
+    client.add_multi(heads, time=EXPIRY, namespace=NAMESPACE)
+    # They may have been looked up while missing
+    client.delete_multi([_missing_key(cache_key) for cache_key in heads],
+                        namespace=NAMESPACE)
+
+
+def start_claims(entities):
+    """Records the versions of newly created entities as the latest
+    written, as advance_claim does, in one batched call"""
+    memcache.add_multi(dict((_claim_key(entity.key.urlsafe()), entity.version)
+                            for entity in entities),
+                       time=EXPIRY, namespace=NAMESPACE)
+
+
+def claim_version(key, version):
+    """Claims the right to write the version of an entity following
+    version. Returns True if claimed, False if a later version has already
+    been written or another writer holds the claim, or None if memcache
+    doesn't know the latest version written, or an earlier claim on the
+    next version lapsed without it being confirmed as written, in which
+    case the caller must check against the datastore instead"""
+    client = memcache.Client()
+    cache_key = key.urlsafe()
+    current = client.get(_claim_key(cache_key), namespace=NAMESPACE)
+    if current is None or current < version:
+        return None
+    elif current > version:
+        return False
+    # Fails if another writer claimed the next version first
+    if not client.add(_version_claim_key(cache_key, version + 1), True,
+                      time=CLAIM_EXPIRY, namespace=NAMESPACE):
+        return False
+    # Fails if the next version was claimed before, and the claim lapsed
+    # or was released without the write being confirmed: it may have been
+    # written all the same, by a writer that died before caching it
+    if not client.add(_claimed_key(cache_key, version + 1), True,
+                      time=EXPIRY, namespace=NAMESPACE):
+        client.delete(_version_claim_key(cache_key, version + 1),
+                      namespace=NAMESPACE)
+        return None
+    return True
+
+
+def advance_claim(key, version):
+    """Records that a version of an entity has been written"""
+    _advance(memcache.Client(), _claim_key(key.urlsafe()), version)
+
+
+def release_claim(key, version):
+    """Releases a claim made by claim_version -- call if the claimed write
+    fails, so that the next writer needn't wait for the claim to expire.
+    The write may have failed after saving, so the next writer of the
+    version checks the datastore"""
+    memcache.delete(_version_claim_key(key.urlsafe(), version + 1),
+                    namespace=NAMESPACE)
+
+
+@ndb.tasklet
+def is_missing_async(key):
+    """Whether a key was recently found not to exist"""
+    missing = yield ndb.get_context().memcache_get(
+        _missing_key(key.urlsafe()), namespace=NAMESPACE)
+    raise ndb.Return(missing is not None)
+
+
+def mark_missing(key):
+    """Remembers, briefly, that a key doesn't exist"""
+    memcache.set(_missing_key(key.urlsafe()), True, time=MISSING_EXPIRY,
+                 namespace=NAMESPACE)
+
+
+def clear_missing(key):
+    """Forgets that a key didn't exist -- call once it has been created"""
+    memcache.delete(_missing_key(key.urlsafe()), namespace=NAMESPACE)
+
+
+def evict(key):
+    """Drops an entity from the cache"""
+    cache_key = key.urlsafe()
+    _local.pop(cache_key)
+    memcache.delete(cache_key, namespace=NAMESPACE)
@@ -0,0 +1,7 @@
+#!/bin/sh
+# Runs the development server with index checking on, so that any query
+# without a matching index in index.yaml fails with NeedIndexError rather
+# than having an index silently added. Extra arguments are passed on to
+# dev_appserver.py, e.g. ./dev_server.sh --port=8081
+cd "$(dirname "$0")" || exit 1
+exec dev_appserver.py --require_indexes=yes "$@" .
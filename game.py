@@ -1,9 +1,16 @@
 """game.py -- Gameplay logic to implement a Concentration (Memory) game 
 using standard playing cards"""
 
+import base64
 import random
 import pydealer as pd
 
+WIN_MESSAGE = ' Congratulations - You win! All cards matched!'
+
+# Ways a board state can be sent to clients: as a list of 'U'/'M' values,
+# as a base64 bitmask of the matched cards, or as a run-length string
+BOARD_ENCODINGS = ('list', 'bitmask', 'rle')
+
 
 def isGameWon(boardState):
     """Check if the board still contains unmatched cards"""
@@ -38,6 +45,37 @@ def initialBoardState(numCards=52):
     return displayBoard
 
 
+def encodeBitmask(boardState):
+    """Encode a board state as a base64 string of bits, one per card in
+    board order (most significant bit first), set where the card has been
+    matched"""
+    bits = bytearray((len(boardState) + 7) // 8)
+    for index, state in enumerate(boardState):
+        if state == 'M':
+            bits[index // 8] |= 0x80 >> (index % 8)
+    return base64.b64encode(bytes(bits))
+
+
+def encodeRunLength(boardState):
+    """Encode a board state as runs of counts and values, e.g. '3U2M1U'"""
+    runs = []
+    for state in boardState:
+        if runs and runs[-1][1] == state:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, state])
+    return ''.join('{0}{1}'.format(count, state) for count, state in runs)
+
+
+def encodeBoard(boardState, encoding):
+    """Encode a board state in one of the compact BOARD_ENCODINGS"""
+    if encoding == 'bitmask':
+        return encodeBitmask(boardState)
+    elif encoding == 'rle':
+        return encodeRunLength(boardState)
+    raise ValueError('Unknown board encoding: {0}'.format(encoding))
+
+
 def splitDeck(deck, numCards):
     """Create a deck that is smaller than the default 52 card deck,
     while making sure that there are an even number of cards, and each
@@ -61,15 +99,23 @@ def compareCards(index1, index2, myBoard, displayBoard):
     a game turn"""
     card1 = myBoard[index1]
     card2 = myBoard[index2]
+    matched = card1[0] == card2[0]
+    if matched:
+        displayBoard[index1] = 'M'
+        displayBoard[index2] = 'M'
+    return describeMove(card1, card2, matched), displayBoard
+
+
+def describeMove(card1, card2, matched):
+    """Build the message reporting the result of a turn, given the
+    two card values played and whether they matched"""
     message = "The first card had value {}. ".format(card1)
     message += "The second card had value {}. ".format(card2)
-    if card1[0] == card2[0]:
+    if matched:
         message += "It's a match!"
-        displayBoard[index1] = 'M'
-        displayBoard[index2] = 'M'
     else:
         message += "Sorry, no match this time. Guess again."
-    return message, displayBoard
+    return message
 
 
 def giveHint(indexValue, myBoard):
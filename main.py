@@ -3,37 +3,52 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import json
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.ext import ndb
 from api import ConcentrationApi
 
-from models import User, Game
+from models import User, Game, Rankings
+import metrics
+
+
+# Number of users sent reminders by each /tasks/send_reminders task
+REMINDER_BATCH = 100
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to Users with incomplete games.
+        """Fan out reminder emails to Users with incomplete games, in
+        batches sent by /tasks/send_reminders tasks.
         Called every 12 hours using a cron job"""
+        # Find the distinct users of all in-progress games, projecting just
+        # the user so that boards and move logs are never loaded
+        games = Game.query(Game.status == 'In Progress',
+                           projection=[Game.user], distinct=True)
+        user_keys = set(game.user for game in games.iter(batch_size=1000))
+        # Enqueue a task for each batch of users, adding the tasks to the
+        # queue in bulk
+        user_keys = [key.urlsafe() for key in user_keys]
+        tasks = [taskqueue.Task(
+                    url='/tasks/send_reminders',
+                    params={'user_key': user_keys[i:i + REMINDER_BATCH]})
+                 for i in range(0, len(user_keys), REMINDER_BATCH)]
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+class SendReminders(webapp2.RequestHandler):
+    def post(self):
+        """Send a reminder email to a batch of Users with incomplete games.
+        Enqueued by SendReminderEmail"""
         app_id = app_identity.get_application_id()
-        # Find all in-progress games
-        games = Game.query(Game.status == 'In Progress')
-        # Make a list of all names of users with in-progress games
-        users = []
-        for game in games:
-            users.append(game.user.get().name)
-        
-        # Deduplicate the list of users, only sending 1 email to each user
-        de_dup_users = []
-        for u in users:
-            if u not in de_dup_users:
-                de_dup_users.append(u)
-
-        for username in de_dup_users:
-            q = User.query(User.name == username)
-            user = q.get()
-            if user.email != None:
+        keys = [ndb.Key(urlsafe=k) for k in self.request.get_all('user_key')]
+        for user in ndb.get_multi(keys):
+            if user and user.email:
                 subject = 'This is a reminder!'
                 body = 'Hello {}, You have unfinished Concentration games!'.format(user.name)
                 # This will send test emails, the arguments to send_mail are:
@@ -42,6 +57,7 @@ class SendReminderEmail(webapp2.RequestHandler):
                                user.email,
                                subject,
                                body)
+        self.response.set_status(204)
 
 
 class UpdateTopScore(webapp2.RequestHandler):
@@ -51,7 +67,57 @@ class UpdateTopScore(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class SyncUserName(webapp2.RequestHandler):
+    def post(self):
+        """Copy a user's current name onto all of their Games and Scores.
+        Enqueue with the user's urlsafe key whenever a name changes."""
+        user = ndb.Key(urlsafe=self.request.get('user_key')).get()
+        if user:
+            user.sync_user_name()
+        self.response.set_status(204)
+
+
+class AdoptLegacyUser(webapp2.RequestHandler):
+    def post(self):
+        """Move a legacy user's Games and Scores to the User keyed by its
+        name, then delete it. Enqueued when a legacy user is first looked
+        up by name"""
+        legacy = ndb.Key(urlsafe=self.request.get('legacy_key')).get()
+        if legacy:
+            User.get_by_id(legacy.name).adopt_legacy(legacy.key)
+        self.response.set_status(204)
+
+
+class RebuildRankings(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the rankings snapshot from scratch.
+        Called every hour using a cron job"""
+        Rankings.rebuild()
+
+
+class PatchRankings(webapp2.RequestHandler):
+    def get(self):
+        """Move the users who have won games since the last run within the
+        rankings snapshot, as queued by Game.win_game.
+        Called every minute using a cron job"""
+        Rankings.apply_patches()
+
+
+class ShowMetrics(webapp2.RequestHandler):
+    def get(self):
+        """Show this instance's endpoint metrics as JSON. Admins only"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(metrics.snapshot(), indent=2,
+                                       sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminders),
     ('/tasks/cache_high_score', UpdateTopScore),
+    ('/tasks/sync_user_name', SyncUserName),
+    ('/tasks/adopt_legacy_user', AdoptLegacyUser),
+    ('/crons/rebuild_rankings', RebuildRankings),
+    ('/crons/patch_rankings', PatchRankings),
+    ('/admin/metrics', ShowMetrics),
 ], debug=True)
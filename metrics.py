@@ -0,0 +1,151 @@
+"""metrics.py - In-process instrumentation of the API's endpoints.
+
+Each instrumented endpoint call records its wall time, the datastore and
+memcache RPCs it made (counted by an apiproxy hook) and the sizes of its
+request and response messages. The figures are aggregated per endpoint
+into histograms held by the instance, which are written to the log every
+few minutes and can be read from /admin/metrics."""
+
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from protorpc import messages, protobuf
+
+# Upper bounds of the histogram buckets, shared by every figure recorded:
+# milliseconds, RPC counts and bytes alike
+BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+           20000, 50000, float('inf'))
+# Seconds between writing the histograms to the log
+FLUSH_INTERVAL = 5 * 60
+
+# The figures recorded for every call, besides response_bytes
+FIGURES = ('wall_ms', 'datastore_gets', 'datastore_puts',
+           'datastore_queries', 'datastore_deletes', 'memcache_hits',
+           'memcache_misses', 'request_bytes')
+
+# The figure counting each datastore call
+DATASTORE_CALLS = {'Get': 'datastore_gets',
+                   'Put': 'datastore_puts',
+                   'RunQuery': 'datastore_queries',
+                   'Next': 'datastore_queries',
+                   'Delete': 'datastore_deletes'}
+
+
+class Histogram(object):
+    """Counts of values falling into each of the BUCKETS"""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding the given fraction of the
+        values, or the largest value if that is lower"""
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': float(self.total) / self.count if self.count else 0,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99)}
+
+
+# Histograms of each figure, by endpoint
+_histograms = {}
+_lock = threading.Lock()
+_last_flush = [time.time()]
+# The figures of the call being handled by the current thread, if any
+_local = threading.local()
+
+
+def _count(figure, amount=1):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats[figure] = stats.get(figure, 0) + amount
+
+
+def _post_call_hook(service, call, request, response):
+    """Counts the datastore and memcache RPCs of an instrumented call"""
+    if service == 'datastore_v3' and call in DATASTORE_CALLS:
+        _count(DATASTORE_CALLS[call])
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        _count('memcache_hits', hits)
+        _count('memcache_misses', request.key_size() - hits)
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'endpoint_metrics', _post_call_hook)
+
+
+def _size(message):
+    """The encoded size of a protorpc message, or None if it won't
+    encode"""
+    try:
+        return len(protobuf.encode_message(message))
+    except messages.ValidationError:
+        return None
+
+
+def record(endpoint, stats):
+    """Adds the figures of one call to the endpoint's histograms, and
+    writes all of the histograms to the log if it is time to"""
+    with _lock:
+        histograms = _histograms.setdefault(endpoint, {})
+        for figure, value in stats.items():
+            if value is not None:
+                histograms.setdefault(figure, Histogram()).add(value)
+        flush = time.time() - _last_flush[0] >= FLUSH_INTERVAL
+        if flush:
+            _last_flush[0] = time.time()
+    if flush:
+        logging.info('Endpoint metrics: %s', json.dumps(snapshot(),
+                                                        sort_keys=True))
+
+
+def snapshot():
+    """Returns a summary of every endpoint's histograms"""
+    with _lock:
+        return dict((endpoint, dict((figure, histogram.to_dict())
+                                    for figure, histogram in figures.items()))
+                    for endpoint, figures in _histograms.items())
+
+
+def instrumented(method):
+    """Decorates an endpoint method, recording the figures of each call"""
+    @functools.wraps(method)
+    def wrapper(service, request):
+        _local.stats = stats = dict.fromkeys(FIGURES, 0)
+        start = time.time()
+        response = None
+        try:
+            response = method(service, request)
+            return response
+        finally:
+            _local.stats = None
+            stats['wall_ms'] = (time.time() - start) * 1000
+            stats['request_bytes'] = _size(request)
+            if response is not None:
+                stats['response_bytes'] = _size(response)
+            record(method.__name__, stats)
+    return wrapper
@@ -5,123 +5,714 @@ definitions for Forms used in transmitting messages to users."""
 
 ### Imports
 
+import logging
 import random
 import pickle
-from datetime import date
+import re
+import struct
+from datetime import date, datetime
 
 import httplib
 import endpoints
 from protorpc import messages
+from google.appengine.api import memcache, taskqueue
 from google.appengine.ext import ndb
 
 ### Import game logic
 
 import game as gm
+import cache
 
 ### User Related Classes and Methods
 
+# Number of shards counting each user's games and score
+COUNTER_SHARDS = 10
+COUNTER_NAMESPACE = 'user-counters'
+# Seconds before cached totals are summed from the shards again
+COUNTER_EXPIRY = 10 * 60
+# Attempts at updating a game while moves are being saved to it
+ADOPT_RETRIES = 5
+
+
 class User(ndb.Model):
-    """User profile"""
-    name = ndb.StringProperty(required=True)
-    email = ndb.StringProperty()
-    total_games = ndb.IntegerProperty(default = 0)
-    total_score = ndb.IntegerProperty(default = 0)
-    avg_score = ndb.FloatProperty(default = 0)
+    """User profile, keyed by the user's (unique) name. Games and scores
+    are counted by UserCounterShards; total_games and total_score hold
+    only what was counted on the User before the counters were sharded"""
+    name = ndb.StringProperty(required=True, indexed=False)
+    email = ndb.StringProperty(indexed=False)
+    total_games = ndb.IntegerProperty(default = 0, indexed=False)
+    total_score = ndb.IntegerProperty(default = 0, indexed=False)
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Returns the User with the given name, or None. A key lookup,
+        so it is strongly consistent and served from ndb's cache; names
+        found not to exist are remembered briefly, too"""
+        if not name:
+            raise ndb.Return(None)
+        key = ndb.Key(cls, name)
+        missing = yield cache.is_missing_async(key)
+        if missing:
+            raise ndb.Return(None)
+        user = yield key.get_async()
+        if user is None:
+            user = yield cls._move_legacy_async(name)
+        if user is None:
+            cache.mark_missing(key)
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.tasklet
+    def _move_legacy_async(cls, name):
+        """Looks for a user created before users were keyed by name, and
+        if there is one, moves it to its name key. Returns the moved user,
+        or None"""
+        # name is no longer indexed, but legacy users were indexed on it
+        q = cls.query(ndb.GenericProperty('name') == name)
+        legacy = yield q.get_async()
+        if legacy is None or legacy.key.id() == name:
+            raise ndb.Return(None)
+        # Its games may have been won since the counters were sharded, so
+        # take the counted totals too, not just those on the User
+        total_games, total_score, _ = legacy.get_totals()
+        raise ndb.Return(cls._move_legacy(legacy, total_games, total_score))
+
+    @classmethod
+    @ndb.transactional
+    def _move_legacy(cls, legacy, total_games, total_score):
+        user = ndb.Key(cls, legacy.name).get()
+        if user is None:
+            user = cls(id=legacy.name, name=legacy.name, email=legacy.email,
+                       total_games=total_games, total_score=total_score)
+            user.put()
+            # Point the legacy user's Games and Scores at the moved user
+            taskqueue.add(url='/tasks/adopt_legacy_user',
+                          params={'legacy_key': legacy.key.urlsafe()},
+                          transactional=True)
+        return user
+
+    def adopt_legacy(self, legacy_key):
+        """Takes over the Games and Scores of the legacy user this user was
+        moved from, then deletes the legacy user. Games won between the
+        move and their adoption were counted for the legacy user, so its
+        final totals replace those copied when this user was moved"""
+        self._adopt(legacy_key)
+        legacy = legacy_key.get()
+        if legacy is None:
+            # Adopted already, by an earlier run of the task
+            return
+        total_games, total_score, _ = legacy.get_totals()
+        self._set_legacy_totals(total_games, total_score)
+        # The leaderboard holds its own copies of the legacy user's Scores
+        Leaderboard.adopt(legacy_key, self)
+        legacy_key.delete()
+
+    @ndb.transactional
+    def _set_legacy_totals(self, total_games, total_score):
+        user = self.key.get()
+        user.total_games = total_games
+        user.total_score = total_score
+        user.put()
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Synchronous version of get_by_name_async"""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    def create(cls, name, email=None):
+        """Creates and returns a new User, or None if the name is taken,
+        including by a user created before users were keyed by name"""
+        if cls.get_by_name(name):
+            return None
+        return cls._create(name, email)
+
+    @classmethod
+    @ndb.transactional
+    def _create(cls, name, email=None):
+        """Runs in a transaction so two requests can't claim the same
+        name"""
+        if cls.get_by_id(name):
+            return None
+        user = cls(id=name, name=name, email=email)
+        user.put()
+        ndb.get_context().call_on_commit(lambda: cache.clear_missing(user.key))
+        return user
 
     def to_form(self):
         """Returns a UserForm representation of a User"""
         form = UserForm()
         form.name = self.name
         form.urlsafe_key = self.key.urlsafe()
-        form.total_games = self.total_games
-        form.total_score = self.total_score
-        form.avg_score = round(self.avg_score)
+        form.total_games, form.total_score, avg_score = self.get_totals()
+        form.avg_score = round(avg_score)
         return form
 
-    def calc_score(self):
-        """Calculate the player's average score -- to be 
-        called whenever a new game is won"""
-        avg_score = self.total_score / self.total_games
+    def get_totals(self):
+        """Returns the user's (total_games, total_score, avg_score)"""
+        return User.get_totals_multi([self])[0]
+
+    @classmethod
+    def get_totals_multi(cls, users):
+        """Returns (total_games, total_score, avg_score) for each of the
+        given users, adding their counter shards to any totals recorded on
+        the User itself. The average is derived, never stored"""
+        totals = []
+        counted = UserCounterShard.totals([user.key for user in users])
+        for user, (games, score) in zip(users, counted):
+            games += user.total_games or 0
+            score += user.total_score or 0
+            totals.append((games, score, cls.calc_score(games, score)))
+        return totals
+
+    @staticmethod
+    def calc_score(total_games, total_score):
+        """Calculate a player's average score from their totals"""
+        if not total_games:
+            return 0
+        avg_score = total_score / total_games
         return avg_score
 
-### Game Related Class and Methods
+    def sync_user_name(self, batch_size=100):
+        """Rewrite the user_name copied onto this user's Games and Scores.
+        Run whenever a user's name changes, or to backfill older entities"""
+        self._adopt(self.key, batch_size)
+
+    def _adopt(self, owner_key, batch_size=100):
+        """Points the Games and Scores owned by owner_key at this user, with
+        its current name. The keys come from keys-only queries, which may
+        be stale, so each entity is read afresh and updated on its own:
+        Games through Game.commit, like any other change to a game, and
+        Scores in a transaction"""
+        for model, adopt in ((Game, self._adopt_game),
+                             (Score, self._adopt_score)):
+            q = model.query(model.user == owner_key)
+            cursor, more = None, True
+            while more:
+                keys, cursor, more = q.fetch_page(
+                    batch_size, start_cursor=cursor, keys_only=True)
+                for key in keys:
+                    adopt(key)
+
+    def _adopt_game(self, key):
+        for _ in range(ADOPT_RETRIES):
+            game = key.get(use_cache=False)
+            if game is None or (game.user == self.key and
+                                game.user_name == self.name):
+                return
+            version = game.version or 0
+            game.user, game.user_name = self.key, self.name
+            try:
+                game.commit(None, version)
+                return
+            except StaleGameError:
+                # A move was saved meanwhile, so read the game again
+                continue
+        raise StaleGameError()
+
+    @ndb.transactional(retries=5)
+    def _adopt_score(self, key):
+        score = key.get()
+        if score is not None and (score.user != self.key or
+                                  score.user_name != self.name):
+            score.user, score.user_name = self.key, self.name
+            score.put()
+
+class UserCounterShard(ndb.Model):
+    """One of the shards counting a user's games and score, keyed by the
+    user's name and the shard's number. Shards are root entities, so that
+    concurrent updates to a user's totals rarely contend"""
+    user = ndb.KeyProperty(kind='User', indexed=False)
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    score = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key, number):
+        """The key of a user's numbered shard"""
+        return ndb.Key(cls, '{0}:{1}'.format(user_key.id(), number))
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def increment_async(cls, user_key, games=0, score=0):
+        """Adds to a user's totals, in a randomly chosen shard. Joins the
+        current transaction, if there is one; the cached totals are
+        updated once it commits"""
+        key = cls.key_for(user_key, random.randint(0, COUNTER_SHARDS - 1))
+        shard = yield key.get_async()
+        if shard is None:
+            shard = cls(key=key, user=user_key)
+        shard.games += games
+        shard.score += score
+        yield shard.put_async()
+        offsets = {_counter_key('games', user_key): games,
+                   _counter_key('score', user_key): score}
+        # Only totals already cached are offset; others are summed afresh
+        ndb.get_context().call_on_commit(lambda: memcache.offset_multi(
+            offsets, namespace=COUNTER_NAMESPACE))
+
+    @classmethod
+    def totals(cls, user_keys):
+        """Returns (games, score) counted by the shards of each user, read
+        from memcache where cached, and otherwise summed from the shards"""
+        cached = memcache.get_multi(
+            [_counter_key(field, k) for k in user_keys
+             for field in ('games', 'score')],
+            namespace=COUNTER_NAMESPACE)
+        missing = [k for k in user_keys
+                   if _counter_key('games', k) not in cached or
+                   _counter_key('score', k) not in cached]
+        if missing:
+            shards = ndb.get_multi([cls.key_for(k, number) for k in missing
+                                    for number in range(COUNTER_SHARDS)])
+            summed = {}
+            for i, user_key in enumerate(missing):
+                own = [shard for shard in
+                       shards[i * COUNTER_SHARDS:(i + 1) * COUNTER_SHARDS]
+                       if shard is not None]
+                summed[_counter_key('games', user_key)] = sum(
+                    shard.games for shard in own)
+                summed[_counter_key('score', user_key)] = sum(
+                    shard.score for shard in own)
+            memcache.add_multi(summed, time=COUNTER_EXPIRY,
+                               namespace=COUNTER_NAMESPACE)
+            cached.update(summed)
+        return [(cached[_counter_key('games', k)],
+                 cached[_counter_key('score', k)]) for k in user_keys]
+
+
+def _counter_key(field, user_key):
+    return '{0}:{1}'.format(field, user_key.id())
+
+### Game Related Classes and Methods
+
+# Each move in a game's move log is packed as: the index of the first card,
+# the index of the second card, a match flag, and the number of seconds
+# elapsed since the game was started
+MOVE_RECORD = struct.Struct('>BBBI')
+
+# Every Game has exactly one GameRecord child, always with this id
+GAME_RECORD_ID = 1
 
-class Game(ndb.Model):
-    """Game object"""
-    board = ndb.StringProperty(repeated=True)
-    boardState = ndb.StringProperty(repeated=True)
+# An entry in the pickled history of a game played before move logs were
+# kept, e.g. 'guess: [3, 17] result: The first card had value ...'
+LEGACY_MOVE = re.compile(r'guess: \[(\d+), (\d+)\] result: ')
+
+
+class CachedModel(ndb.Model):
+    """Base for entities that are written through to the cache (see
+    cache.py) whenever they are put. Each put bumps the version, so the
+    cache never replaces a newer copy with an older one"""
+    # The cache takes the place of ndb's own memcache layer
+    _use_memcache = False
+
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # Set on entities that the code putting them caches itself, in a batch
+    _cached_by_caller = False
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+    def _post_put_hook(self, future):
+        if future.get_exception() is not None or self._cached_by_caller:
+            return
+        if ndb.in_transaction():
+            # Only cache what is actually committed
+            ndb.get_context().call_on_commit(lambda: self._cache())
+        else:
+            self._cache()
+
+    def _cache(self):
+        cache.store(self)
+        if self.version == 1:
+            # Newly created, so it may have been looked up while missing
+            cache.clear_missing(self.key)
+
+
+class StaleGameError(Exception):
+    """Raised when a change is saved against a version of a Game that has
+    since been changed by another request"""
+
+
+class Game(CachedModel):
+    """Game object -- the small, frequently read state of a game. The
+    board and move log live in the Game's GameRecord"""
+    boardState = ndb.StringProperty(repeated=True, indexed=False)
+    # guesses and cards stay indexed for the listing projections
     guesses = ndb.IntegerProperty(required=True, default=0)
     cards = ndb.IntegerProperty(required=True, default=52)
     status = ndb.StringProperty(required=True, default='In Progress')
     user = ndb.KeyProperty(required=True, kind='User')
-    history = ndb.PickleProperty(repeated=True)
-    score = ndb.FloatProperty()
+    user_name = ndb.StringProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    score = ndb.FloatProperty(indexed=False)
+    # The board of a game dealt before boards were kept in GameRecords,
+    # until it is moved into one
+    board = ndb.StringProperty(repeated=True, indexed=False)
+    # The version of the GameRecord last saved along with the game, so a
+    # cached record that lags behind the game can be told apart
+    record_version = ndb.IntegerProperty(indexed=False)
 
     @classmethod
-    def new_game(self, user, cards=52):
-        """Creates and returns a new game"""
+    def new_games(cls, users, count=1, cards=52):
+        """Creates count new games for each of the given (distinct) users.
+        Ids are allocated in one call, and the games and their GameRecords
+        are written and cached in batches, then each user's game total is
+        counted once. Returns the new games"""
+        cls.check_cards(cards)
+        first, _ = Game.allocate_ids(len(users) * count)
+        ids = iter(xrange(first, first + len(users) * count))
+        games = []
+        entities = []
+        for user in users:
+            for _ in xrange(count):
+                newGame, record = Game.build(ndb.Key(Game, next(ids)), user,
+                                             cards)
+                games.append(newGame)
+                entities.extend([newGame, record])
+        for entity in entities:
+            entity._cached_by_caller = True
+        ndb.put_multi(entities)
+        for entity in entities:
+            entity._cached_by_caller = False
+        cache.store_created(entities)
+        cache.start_claims(games)
+        # Each user is counted once, however many games they were dealt,
+        # and only once the games are saved
+        counted = [UserCounterShard.increment_async(user.key, games=count)
+                   for user in users]
+        for future in counted:
+            future.get_result()
+        return games
+
+    @staticmethod
+    def check_cards(cards):
+        """Raises ValueError unless cards is a dealable number of cards"""
         if cards < 8 or cards > 52 or cards % 2 != 0:
             raise ValueError('Cards dealt must be an even number between 8 and 52')
-        newGame = Game(board=gm.constructBoard(cards),
+
+    @classmethod
+    def build(self, key, user, cards=52):
+        """Deals a new game under the given (allocated) key, returning the
+        unsaved Game and GameRecord so the caller can batch their puts"""
+        self.check_cards(cards)
+        newGame = Game(key=key,
                     boardState=gm.initialBoardState(cards),
                     guesses=0,
                     cards=cards,
                     status='In Progress',
-                    user=user)
-        newGame.put()
-        return newGame
+                    user=user.key,
+                    user_name=user.name,
+                    record_version=1)
+        record = GameRecord(key=newGame.record_key,
+                            board=gm.constructBoard(cards))
+        return newGame, record
+
+    @classmethod
+    @ndb.tasklet
+    def load_async(cls, key, with_record=False):
+        """Fetches a Game through the cache and, if asked, its GameRecord
+        at the same time. Returns a (game, record) tuple"""
+        if not with_record:
+            game = yield cache.get_async(key)
+            raise ndb.Return(game, None)
+        game, record = yield (cache.get_async(key),
+                              cache.get_async(GameRecord.key_for(key)))
+        if game is not None and record is None and game.board:
+            record = game._move_board_to_record()
+        elif (game is not None and record is not None and
+              game.record_version is not None and
+              record.version != game.record_version):
+            # Read while a change was being cached, with one of the pair
+            # cached and not yet the other: read both from the datastore,
+            # where they were saved together
+            game, record = yield ndb.get_multi_async([key, record.key],
+                                                     use_cache=False)
+            for entity in (game, record):
+                if entity is not None:
+                    entity._cache()
+        raise ndb.Return(game, record)
+
+    def _move_board_to_record(self):
+        """Moves the board of a game dealt before GameRecords existed into
+        a new GameRecord, returning the record. The game's history of
+        moves is moved into the record's move log; when they were played
+        wasn't kept, so each is logged at 0 seconds"""
+        record = GameRecord(key=self.record_key, board=self.board)
+        for card1, card2 in self._pop_legacy_history():
+            if card1 < len(record.board) and card2 < len(record.board):
+                matched = record.board[card1][0] == record.board[card2][0]
+                record.record_move(card1, card2, matched)
+        self.board = []
+        try:
+            self.commit(record, self.version or 0)
+        except StaleGameError:
+            # Another request changed the game first, and may have moved
+            # the board itself
+            return self.record_key.get(use_cache=False)
+        return record
+
+    def _pop_legacy_history(self):
+        """Removes the pickled history property of a game played before
+        move logs were kept, returning its moves as (card1, card2). The
+        property is no longer declared, but ndb keeps it on the entity and
+        writes it back until it is removed"""
+        prop = self._properties.get('history')
+        if prop is None:
+            return []
+        entries = prop._get_value(self)
+        del self._properties['history']
+        self._values.pop('history', None)
+        if not isinstance(entries, list):
+            entries = [entries]
+        moves = []
+        for entry in entries:
+            try:
+                entry = pickle.loads(entry)
+            except Exception:
+                # Not pickled after all, so already the entry's text
+                pass
+            match = (isinstance(entry, basestring) and
+                     LEGACY_MOVE.match(entry))
+            if match:
+                moves.append((int(match.group(1)), int(match.group(2))))
+        return moves
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    @property
+    def record_key(self):
+        """The key of this game's GameRecord"""
+        return GameRecord.key_for(self.key)
+
+    def to_form(self, message, encoding=None):
+        """Returns a GameForm representation of the Game. With a compact
+        encoding (see game.BOARD_ENCODINGS), the board state is sent
+        encoded as encoded_board_state rather than listed in boardState"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = self.user_name or self.user.get().name
         form.guesses = self.guesses
         form.cards = self.cards
         form.status = self.status
         form.message = message
-        form.boardState = self.boardState
+        if encoding and encoding != 'list':
+            form.encoded_board_state = gm.encodeBoard(self.boardState,
+                                                      encoding)
+            form.encoding = encoding
+        else:
+            form.boardState = self.boardState
+        form.version = self.version
         return form
 
-    def to_mini_form(self):
-        """Return a MiniGameForm representation of a Game"""
-        form = MiniGameForm()
+    def to_delta_form(self, message, record, card1, card2):
+        """Returns a GameForm carrying only what a move changed: the
+        values of the two cards played and, if they matched, their
+        indices. The board state is left out, so the size of the response
+        doesn't grow with the board"""
+        form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
         form.guesses = self.guesses
         form.cards = self.cards
         form.status = self.status
+        form.message = message
+        form.version = self.version
+        form.revealed = [record.board[card1], record.board[card2]]
+        if record.board[card1][0] == record.board[card2][0]:
+            form.changed = [card1, card2]
+        return form
+
+    def to_mini_form(self, status=None):
+        """Return a MiniGameForm representation of a Game. Only reads the
+        key, guesses, cards and status, so it also works on projections;
+        pass status when the query filtered on it (and so can't project
+        it)"""
+        form = MiniGameForm()
+        form.urlsafe_key = self.key.urlsafe()
+        form.guesses = self.guesses
+        form.cards = self.cards
+        form.status = status or self.status
         return form
 
-    def to_history_form(self):
-        """Returns a game history form after a game has been won"""
+    def to_history_form(self, record=None, offset=0, limit=None):
+        """Returns a game history form after a game has been won. Without
+        a GameRecord, only the summary is returned; otherwise the board
+        and the requested page of moves, the only moves decoded"""
         form = HistoryForm()
         form.urlsafe_key = self.key.urlsafe()
         form.cards = self.cards
         form.guesses = self.guesses
-        form.board = self.board
         form.score = self.score
-        form.history = [h for h in self.history]
+        # Every guess is one move, so the summary needs no GameRecord
+        form.total_moves = self.guesses
+        if record is None:
+            return form
+        form.total_moves = record.move_count()
+        form.board = record.board
+        offset = max(offset or 0, 0)
+        stop = form.total_moves
+        if limit is not None:
+            stop = min(offset + limit, stop)
+        won = self.status == 'Won'
+        form.history = [record.describe_move(i, won, *move) for i, move in
+                        enumerate(record.iter_moves(offset, stop), offset)]
+        if stop < form.total_moves:
+            form.next_offset = stop
         return form
 
-    def win_game(self):
-        """Updates score and user information once game is won"""
+    def play_move(self, record, card1, card2):
+        """Plays two cards, updating the board state, guess count and the
+        record's move log. Returns the message describing the result"""
+        message, self.boardState = gm.compareCards(
+            card1, card2, record.board, self.boardState)
+        self.guesses += 1
+        matched = record.board[card1][0] == record.board[card2][0]
+        record.record_move(card1, card2, matched, self.started)
+        return message
+
+    def _cache(self):
+        super(Game, self)._cache()
+        # Keep moves claimed against an older version from being saved
+        cache.advance_claim(self.key, self.version)
+
+    def commit(self, record, version):
+        """Saves changes made to the given version of the game, along with
+        its GameRecord if given, and the win if a move completed the game.
+        Every change to a game is saved this way, so that only one change
+        can be made to each version. The next version is claimed in
+        memcache first, so no lock is taken; only if memcache doesn't know
+        the game's version is it checked in a transaction. Raises
+        StaleGameError if the game has changed since that version"""
+        claimed = cache.claim_version(self.key, version)
+        if claimed is False:
+            raise StaleGameError()
+        try:
+            if self.status == 'In Progress' and gm.isGameWon(self.boardState):
+                self.win_game(record, None if claimed else version)
+            elif claimed:
+                self._put(record)
+            else:
+                self._commit_checked(record, version)
+        except BaseException:
+            if claimed:
+                # Let the next change claim the version straight away,
+                # rather than waiting for the claim to expire
+                cache.release_claim(self.key, version)
+            raise
+
+    @ndb.transactional(retries=5)
+    def _commit_checked(self, record, version):
+        """Saves the game and its GameRecord (in the same entity group),
+        provided the stored game is still at the given version"""
+        self._check_version(version)
+        self._put(record)
+
+    def _put(self, record, *others):
+        """Puts the game, its GameRecord if given and any other entities
+        in one batch, noting on the game the version the record is saved
+        at"""
+        if record is not None:
+            self.record_version = (record.version or 0) + 1
+        ndb.put_multi([e for e in (self, record) + others if e is not None])
+
+    def _check_version(self, version):
+        """Within a transaction, raises StaleGameError unless the stored
+        game is at the given version"""
+        stored = self.key.get(use_cache=False)
+        if stored is None or (stored.version or 0) != version:
+            if stored is not None:
+                # The cache may have missed the change, so that a retry
+                # would load the same version again
+                stored._cache()
+            raise StaleGameError()
+
+    def win_game(self, record, version=None):
+        """Marks the game won and records the result, then offers the new
+        score to the leaderboard. If version is given, the win is only
+        saved if the stored game is still at that version"""
+        score = self._commit_win(record, version)
+        # The win is saved by now, so a failure here mustn't fail the move
+        try:
+            if Leaderboard.submit(score) == 1:
+                # A new high score, so refresh the cached announcement
+                taskqueue.add(url='/tasks/cache_high_score')
+        except Exception:
+            logging.exception('Could not submit score %s to the leaderboard',
+                              score.key)
+        return score
+
+    @ndb.transactional(xg=True, retries=5)
+    def _commit_win(self, record, version):
+        """The Game and its GameRecord, the new Score and the user's
+        updated score total are written together in one cross-group
+        transaction. The total is kept in a counter shard, so concurrent
+        wins by the same user rarely contend"""
+        if version is not None:
+            self._check_version(version)
         # Add the game to the score 'board'
         total_score = int(round((self.cards ** 4) / self.guesses))
+        self.status = 'Won'
         self.score = total_score
-        self.put()
-        score = Score(user=self.user, date=date.today(), cards=self.cards, 
+        if not self.user_name:
+            # Dealt before names were copied onto games, so the Score
+            # would have no name once a legacy owner has been adopted
+            owner = self.user.get()
+            self.user_name = owner.name if owner else None
+        score = Score(user=self.user, user_name=self.user_name,
+                      date=date.today(), cards=self.cards,
                       guesses=self.guesses, score=total_score)
-        score.put()
-        user = self.user.get()
-        # Add the current score to the user's total score, but handle error
-        # if user's current score is 0
-        try:
-            user.total_score += total_score
-        except TypeError:
-            user.total_score = total_score
-        user.put()
-        user.avg_score = user.calc_score()
-        user.put()
+        counted = UserCounterShard.increment_async(self.user,
+                                                   score=total_score)
+        self._put(record, score)
+        counted.get_result()
+        # Move the user within the rankings snapshot once this commits
+        Rankings.queue_patch(self.user)
+        return score
+
+
+class GameRecord(CachedModel):
+    """The cold payload of a Game: the dealt board and the packed move
+    log. Stored as a child of the Game, so it is only read by the
+    endpoints that need the board or the history"""
+    board = ndb.StringProperty(repeated=True, indexed=False)
+    moves = ndb.BlobProperty()
+
+    @classmethod
+    def key_for(cls, game_key):
+        """Returns the key of the GameRecord belonging to a Game"""
+        return ndb.Key(cls, GAME_RECORD_ID, parent=game_key)
+
+    def record_move(self, card1, card2, matched, started=None):
+        """Appends a single packed move to the move log"""
+        elapsed = 0
+        if started:
+            elapsed = int((datetime.utcnow() - started).total_seconds())
+        self.moves = (self.moves or '') + MOVE_RECORD.pack(
+            card1, card2, int(matched), max(elapsed, 0))
+
+    def iter_moves(self, start=0, stop=None):
+        """Yields (card1, card2, matched, elapsed) tuples from the move log,
+        decoding only the moves numbered start up to (not including) stop"""
+        log = self.moves or ''
+        if stop is None:
+            stop = self.move_count()
+        for offset in range(start * MOVE_RECORD.size,
+                            min(stop * MOVE_RECORD.size, len(log)),
+                            MOVE_RECORD.size):
+            card1, card2, matched, elapsed = MOVE_RECORD.unpack_from(
+                log, offset)
+            yield card1, card2, bool(matched), elapsed
+
+    def describe_move(self, index, won, card1, card2, matched, elapsed):
+        """Renders a logged move as a human-readable history entry"""
+        message = gm.describeMove(self.board[card1], self.board[card2],
+                                  matched)
+        # The final move of a won game is the one that won it
+        if won and index == self.move_count() - 1:
+            message += gm.WIN_MESSAGE
+        return 'guess: {0} result: {1}'.format([card1, card2], message)
+
+    def move_count(self):
+        """Returns the number of moves in the move log"""
+        return len(self.moves or '') // MOVE_RECORD.size
 
 
 ### Score Class and Methods
@@ -129,19 +720,381 @@ class Game(ndb.Model):
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
-    date = ndb.DateProperty(required=True)
-    cards = ndb.IntegerProperty(required=True)
-    guesses = ndb.IntegerProperty(required=True)
+    user_name = ndb.StringProperty(indexed=False)
+    date = ndb.DateProperty(required=True, indexed=False)
+    cards = ndb.IntegerProperty(required=True, indexed=False)
+    guesses = ndb.IntegerProperty(required=True, indexed=False)
     score = ndb.FloatProperty(required=True)
 
     def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, 
+        return ScoreForm(user_name=self.user_name or self.user.get().name,
                          cards=self.cards,
                          date=str(self.date), 
                          guesses=self.guesses, 
                          score=self.score)
 
 
+### Leaderboard Class and Methods
+
+LEADERBOARD_ID = 'high_scores'
+LEADERBOARD_SIZE = 10
+
+
+class Leaderboard(CachedModel):
+    """The top scores, kept in a single cached entity that is updated as
+    qualifying games are won, so high-score reads never query Scores"""
+    entries = ndb.LocalStructuredProperty(Score, repeated=True,
+                                          keep_keys=True)
+
+    @classmethod
+    def load(cls):
+        """Returns the leaderboard, rebuilding it from the Scores if it
+        doesn't exist yet"""
+        board = cache.get(ndb.Key(cls, LEADERBOARD_ID))
+        if board is None:
+            q = Score.query().order(-Score.score)
+            scores = resolve_user_names(q.fetch(LEADERBOARD_SIZE))
+            board = cls.get_or_insert(LEADERBOARD_ID, entries=scores)
+        return board
+
+    def qualifies(self, score):
+        """Whether a score would earn a place on the leaderboard"""
+        return (len(self.entries) < LEADERBOARD_SIZE or
+                score.score > self.entries[-1].score)
+
+    @classmethod
+    def submit(cls, score):
+        """Adds a newly won score to the leaderboard if it qualifies.
+        Returns the score's place on the leaderboard (1 for the high
+        score), or None if the leaderboard didn't change"""
+        # Checking the cached copy first means most wins never write
+        if not cls.load().qualifies(score):
+            return None
+        return cls._insert(score)
+
+    @classmethod
+    @ndb.transactional(retries=5)
+    def _insert(cls, score):
+        board = ndb.Key(cls, LEADERBOARD_ID).get()
+        if board is None or not board.qualifies(score):
+            return None
+        # The score may already be there, if it was won just before a
+        # rebuild
+        if any(entry.key == score.key for entry in board.entries):
+            return None
+        board.entries.append(score)
+        board.entries.sort(key=lambda s: s.score, reverse=True)
+        del board.entries[LEADERBOARD_SIZE:]
+        board.put()
+        return [entry.key for entry in board.entries].index(score.key) + 1
+
+    @classmethod
+    @ndb.transactional(retries=5)
+    def adopt(cls, owner_key, user):
+        """Points the entries owned by owner_key at user, with its name"""
+        board = ndb.Key(cls, LEADERBOARD_ID).get()
+        if board is None:
+            return
+        owned = [entry for entry in board.entries if entry.user == owner_key]
+        for entry in owned:
+            entry.user = user.key
+            entry.user_name = user.name
+        if owned:
+            board.put()
+
+
+### Rankings Snapshot Classes and Methods
+
+RANKINGS_ID = 'rankings'
+RANKINGS_PAGE_SIZE = 50
+# Number of snapshot pages written per batch while rebuilding
+RANKINGS_WRITE_BATCH = 20
+# The pull queue of users whose entries need moving after a win, and the
+# number of them moved by each transaction
+RANKINGS_PATCH_QUEUE = 'rankings-patches'
+RANKINGS_PATCH_BATCH = 100
+# Batches applied by each run of /crons/patch_rankings, and the seconds
+# each batch's tasks are leased for
+RANKINGS_PATCH_RUNS = 10
+RANKINGS_PATCH_LEASE = 60
+
+
+class RankEntry(ndb.Model):
+    """A single user's line in the rankings snapshot"""
+    name = ndb.StringProperty()
+    total_games = ndb.IntegerProperty()
+    total_score = ndb.IntegerProperty()
+    avg_score = ndb.FloatProperty()
+
+    @classmethod
+    def from_user(cls, user, totals):
+        """Returns the entry for a user, given their totals (see
+        User.get_totals)"""
+        total_games, total_score, avg_score = totals
+        return cls(name=user.name, total_games=total_games,
+                   total_score=total_score, avg_score=avg_score)
+
+    def to_form(self, rank):
+        """Returns a UserForm for the entry, at the given rank"""
+        return UserForm(name=self.name,
+                        urlsafe_key=ndb.Key(User, self.name).urlsafe(),
+                        total_games=self.total_games,
+                        total_score=self.total_score,
+                        avg_score=round(self.avg_score or 0),
+                        rank=rank)
+
+
+class RankingsPage(CachedModel):
+    """One page of the rankings snapshot, keyed by page number (from 1),
+    as a child of the Rankings index. The names of the users on the page
+    are indexed, so a user's page can be found without reading pages"""
+    entries = ndb.LocalStructuredProperty(RankEntry, repeated=True,
+                                          compressed=True)
+    names = ndb.StringProperty(repeated=True)
+
+    @classmethod
+    def key_for(cls, number):
+        """The key of a numbered page"""
+        return ndb.Key(cls, number, parent=ndb.Key(Rankings, RANKINGS_ID))
+
+    @classmethod
+    def find_key(cls, name):
+        """The key of the page listing a user, or None. An ancestor query,
+        so it is strongly consistent and can run in a transaction"""
+        return cls.find_key_async(name).get_result()
+
+    @classmethod
+    def find_key_async(cls, name):
+        """Asynchronous version of find_key"""
+        return cls.query(cls.names == name,
+                         ancestor=ndb.Key(Rankings, RANKINGS_ID)).get_async(
+                             keys_only=True)
+
+    def _pre_put_hook(self):
+        self.names = [entry.name for entry in self.entries]
+        super(RankingsPage, self)._pre_put_hook()
+
+
+class Rankings(CachedModel):
+    """Index of the rankings snapshot: the number of users on each page,
+    and the lowest average score on each page. Rebuilt periodically by a
+    cron job, and patched as games are won"""
+    page_sizes = ndb.IntegerProperty(repeated=True, indexed=False)
+    page_floors = ndb.FloatProperty(repeated=True, indexed=False)
+    built = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def load(cls):
+        """Returns the snapshot index, building the snapshot if needed"""
+        return cache.get(ndb.Key(cls, RANKINGS_ID)) or cls.rebuild()
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuilds the whole snapshot from the Users, best first. Averages
+        are derived from the users' counters rather than stored, so every
+        user is read and the entries are sorted here. Users are read in
+        batches and only a (avg_score, name, total_games, total_score)
+        tuple is kept for each, around 200 bytes, so a snapshot of 100,000
+        users needs about 20MB; the entries themselves are only built a
+        batch of pages at a time"""
+        index = (ndb.Key(cls, RANKINGS_ID).get() or
+                 cls(id=RANKINGS_ID))
+        index.page_sizes, index.page_floors = [], []
+        ranked = []
+        q = User.query()
+        cursor, more = None, True
+        while more:
+            users, cursor, more = q.fetch_page(RANKINGS_PAGE_SIZE * 10,
+                                               start_cursor=cursor)
+            ranked.extend((avg_score, user.name, games, score)
+                          for user, (games, score, avg_score)
+                          in zip(users, User.get_totals_multi(users)))
+        ranked.sort(key=lambda line: (-line[0], line[1]))
+        batch = RANKINGS_PAGE_SIZE * RANKINGS_WRITE_BATCH
+        for i in range(0, len(ranked), batch):
+            entries = [RankEntry(name=name, total_games=games,
+                                 total_score=score, avg_score=avg_score)
+                       for avg_score, name, games, score
+                       in ranked[i:i + batch]]
+            index._write_pages([entries[j:j + RANKINGS_PAGE_SIZE] for j
+                                in range(0, len(entries), RANKINGS_PAGE_SIZE)])
+        # Drop any pages left over from a larger snapshot, or stored before
+        # pages were children of the index
+        stale = [key for key in RankingsPage.query().iter(keys_only=True)
+                 if key.parent() is None or key.id() > len(index.page_sizes)]
+        ndb.delete_multi(stale)
+        for key in stale:
+            cache.evict(key)
+        index.built = datetime.utcnow()
+        index.put()
+        return index
+
+    def _write_pages(self, pages):
+        """Writes the next pages of a rebuild, recording them in the
+        index. Existing pages are updated in place, so that their cached
+        versions keep moving forward"""
+        first = len(self.page_sizes) + 1
+        keys = [RankingsPage.key_for(number)
+                for number in range(first, first + len(pages))]
+        updated = []
+        for key, page, entries in zip(keys, ndb.get_multi(keys), pages):
+            page = page or RankingsPage(key=key)
+            page.entries = entries
+            updated.append(page)
+            self.page_sizes.append(len(entries))
+            self.page_floors.append(entries[-1].avg_score)
+        ndb.put_multi(updated)
+
+    def candidate_pages(self, avg_score):
+        """Returns the numbers of the pages whose range of average scores
+        takes in avg_score -- more than one when ties span pages"""
+        candidates = []
+        ceiling = float('inf')
+        for number, floor in enumerate(self.page_floors, 1):
+            if floor <= avg_score <= ceiling:
+                candidates.append(number)
+            ceiling = floor
+        if not candidates and self.page_floors:
+            # Lower than everyone in the snapshot
+            candidates.append(len(self.page_floors))
+        return candidates
+
+    def get_page(self, number):
+        """Returns a page of the snapshot as a list of (rank, entry)"""
+        page = cache.get(RankingsPage.key_for(number))
+        if page is None:
+            return []
+        first = sum(self.page_sizes[:number - 1]) + 1
+        return list(enumerate(page.entries, first))
+
+    def find(self, name):
+        """Returns (page number, rank) of a user, or None if the user is
+        not in the snapshot"""
+        key = RankingsPage.find_key(name)
+        if key is None:
+            return None
+        for rank, entry in self.get_page(key.id()):
+            if entry.name == name:
+                return key.id(), rank
+        return None
+
+    def neighbors(self, number, rank, count):
+        """Returns up to count (rank, entry) pairs either side of a rank,
+        along with the entry itself, reading adjacent pages as needed"""
+        entries = self.get_page(number)
+        if entries and rank - count < entries[0][0] and number > 1:
+            entries = self.get_page(number - 1) + entries
+        if (entries and rank + count > entries[-1][0] and
+                number < len(self.page_sizes)):
+            entries = entries + self.get_page(number + 1)
+        return [(r, e) for r, e in entries if abs(r - rank) <= count]
+
+    @staticmethod
+    def queue_patch(user_key):
+        """Queues a user's entry to be moved by the next run of
+        /crons/patch_rankings. Joins the current transaction, if any"""
+        taskqueue.Queue(RANKINGS_PATCH_QUEUE).add(
+            taskqueue.Task(payload=user_key.urlsafe(), method='PULL'),
+            transactional=ndb.in_transaction())
+
+    @classmethod
+    def apply_patches(cls):
+        """Moves the users queued by wins since the last run, a batch at a
+        time. Every page shares the index's entity group, so patching in
+        batches keeps wins from contending for it one write each"""
+        queue = taskqueue.Queue(RANKINGS_PATCH_QUEUE)
+        for _ in range(RANKINGS_PATCH_RUNS):
+            tasks = queue.lease_tasks(RANKINGS_PATCH_LEASE,
+                                      RANKINGS_PATCH_BATCH)
+            if not tasks:
+                break
+            # A user who won several times is moved once
+            keys = list(set(ndb.Key(urlsafe=task.payload) for task in tasks))
+            users = [user for user in ndb.get_multi(keys) if user]
+            if users:
+                cls.patch(users, User.get_totals_multi(users))
+            queue.delete_tasks(tasks)
+
+    @classmethod
+    @ndb.transactional(retries=5)
+    def patch(cls, users, totals):
+        """Moves each of the given (distinct) users' entries to reflect
+        their new totals (see User.get_totals_multi), in one transaction.
+        Left to the next rebuild if there is no snapshot yet. The pages
+        are children of the index, so only one entity group is touched"""
+        index = ndb.Key(cls, RANKINGS_ID).get()
+        if index is None or not index.page_sizes:
+            return
+        changed = {}
+
+        def load_page(number):
+            if number not in changed:
+                changed[number] = RankingsPage.key_for(number).get()
+            return changed[number]
+
+        # Find every user's page at once. Only the patched users' own
+        # entries move, so the pages found stay right as each is moved
+        old_keys = [f.get_result() for f in
+                    [RankingsPage.find_key_async(u.name) for u in users]]
+        for user, user_totals, old_key in zip(users, totals, old_keys):
+            # Remove the user's old entry, if they have one
+            if old_key is not None:
+                entries = load_page(old_key.id()).entries
+                names = [e.name for e in entries]
+                if user.name in names:
+                    del entries[names.index(user.name)]
+            # Insert the new entry ahead of anyone with a lower average
+            entry = RankEntry.from_user(user, user_totals)
+            number = index.candidate_pages(entry.avg_score)[0]
+            entries = load_page(number).entries
+            position = len(entries)
+            for i, e in enumerate(entries):
+                if e.avg_score < entry.avg_score:
+                    position = i
+                    break
+            entries.insert(position, entry)
+            # Keep the floors right for the users still to be placed
+            for number, page in changed.items():
+                index.page_sizes[number - 1] = len(page.entries)
+                if page.entries:
+                    index.page_floors[number - 1] = page.entries[-1].avg_score
+        ndb.put_multi(changed.values() + [index])
+
+    def to_form(self, entries, page):
+        """Returns a RankingsForm of (rank, entry) pairs"""
+        return RankingsForm(users=[e.to_form(rank) for rank, e in entries],
+                            page=page,
+                            total_pages=len(self.page_sizes),
+                            built=str(self.built))
+
+
+### Serialization Helpers
+
+def resolve_user_names(entities):
+    """Fill in user_name on a page of Games or Scores that were stored
+    without it, resolving all of their User keys in a single batch"""
+    missing = list(set(e.user for e in entities if not e.user_name))
+    if missing:
+        names = dict((u.key, u.name) for u in ndb.get_multi(missing) if u)
+        for e in entities:
+            if not e.user_name:
+                e.user_name = names.get(e.user)
+    return entities
+
+
+def to_forms(entities, form_method='to_form', resolve_users=True,
+             **kwargs):
+    """Serialize a page of entities into forms, batching any lookups of
+    referenced Users rather than fetching them one row at a time. Pass
+    resolve_users=False when the form does not include the user's name;
+    any other keyword arguments are passed on to the form method"""
+    entities = list(entities)
+    if (resolve_users and entities and
+            'user_name' in entities[0]._properties):
+        resolve_user_names(entities)
+    return [getattr(e, form_method)(**kwargs) for e in entities]
+
+
 ### Game Forms -- Display
 
 class GameForm(messages.Message):
@@ -153,6 +1106,12 @@ class GameForm(messages.Message):
     boardState = messages.StringField(5, repeated=True)
     user_name = messages.StringField(6)
     cards = messages.IntegerField(7)
+    version = messages.IntegerField(8)
+    changed = messages.IntegerField(9, repeated=True)
+    revealed = messages.StringField(10, repeated=True)
+    # The board state in a compact encoding -- not the dealt board
+    encoded_board_state = messages.StringField(11)
+    encoding = messages.StringField(12)
 
 
 class MiniGameForm(messages.Message):
@@ -170,17 +1129,33 @@ class HistoryForm(messages.Message):
     board = messages.StringField(4, repeated=True)
     score = messages.FloatField(5)
     history = messages.StringField(6, repeated=True)
+    total_moves = messages.IntegerField(7)
+    next_offset = messages.IntegerField(8)
 
 
 class MiniGameForms(messages.Message):
     """Hold a list of abbreviated Game Forms"""
     games = messages.MessageField(MiniGameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
     cards = messages.IntegerField(2, default=52)
+    encoding = messages.StringField(3)
+
+
+class NewGamesForm(messages.Message):
+    """Used to create games in bulk, e.g. for a tournament"""
+    user_names = messages.StringField(1, repeated=True)
+    games_per_user = messages.IntegerField(2, default=1)
+    cards = messages.IntegerField(3, default=52)
+
+
+class GameForms(messages.Message):
+    """Hold a list of Game Forms"""
+    games = messages.MessageField(GameForm, 1, repeated=True)
 
 
 ### Gameplay Forms
@@ -199,6 +1174,8 @@ class MakeGuessForm(messages.Message):
     """Used to make a move in an existing game"""
     card1 = messages.IntegerField(1, required=True)
     card2 = messages.IntegerField(2, required=True)
+    version = messages.IntegerField(3)
+    encoding = messages.StringField(4)
 
 
 class HintForm(messages.Message):
@@ -220,6 +1197,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 ## User and Rankings Message Classes
@@ -231,11 +1209,15 @@ class UserForm(messages.Message):
     total_games = messages.IntegerField(3)
     total_score = messages.IntegerField(4)
     avg_score = messages.FloatField(5)
+    rank = messages.IntegerField(6)
 
 
-class UserForms(messages.Message):
-    """Return information mulitiple users for ranking"""
+class RankingsForm(messages.Message):
+    """A page of the rankings snapshot, or a user and their neighbors"""
     users = messages.MessageField(UserForm, 1, repeated=True)
+    page = messages.IntegerField(2)
+    total_pages = messages.IntegerField(3)
+    built = messages.StringField(4)
 
 
 ### Assorted Message Classes
@@ -0,0 +1,83 @@
+"""ratelimit.py - Per-game and per-user rate limiting of the gameplay
+endpoints.
+
+Each limited endpoint allows a game a number of calls per period, and
+the user owning the game a larger number across all of their games. Calls
+are counted in memcache with atomic increments, in fixed windows of one
+period; the previous window's count is weighted by how much of it still
+falls within the last period, so the limit behaves like a token bucket
+that refills steadily rather than resetting all at once. An instance that
+has seen a game or user go over its limit remembers it until the window
+ends, and rejects further calls without asking memcache."""
+
+import functools
+import time
+
+from google.appengine.api import memcache
+import endpoints
+
+import cache
+
+NAMESPACE = 'rate-limit'
+
+# Games and users recently found over a limit, and when their current
+# window ends
+_throttled = cache.LRU(1000)
+
+
+class RateLimitExceededException(endpoints.ForbiddenException):
+    """Raised when a client calls an endpoint faster than it allows.
+    Endpoints can't send 429 Too Many Requests, so this is a 403"""
+
+
+def _window_key(bucket, window):
+    return '{0}:{1}'.format(bucket, window)
+
+
+def allow(name, subject, calls, period):
+    """Counts a call to the named endpoint for subject, returning whether
+    it is within the limit of calls per period (in seconds). Calls are
+    allowed if memcache is unavailable"""
+    now = time.time()
+    window = int(now // period)
+    bucket = '{0}:{1}'.format(name, subject)
+    if _throttled.get(bucket, 0) > now:
+        return False
+    client = memcache.Client()
+    key = _window_key(bucket, window)
+    count = client.incr(key, namespace=NAMESPACE)
+    if count is None:
+        # The first call of the window; incr can't set an expiry
+        if client.add(key, 1, time=period * 2, namespace=NAMESPACE):
+            count = 1
+        else:
+            count = client.incr(key, namespace=NAMESPACE) or 1
+    previous = client.get(_window_key(bucket, window - 1),
+                          namespace=NAMESPACE) or 0
+    overlap = 1 - (now % period) / float(period)
+    if count + previous * overlap > calls:
+        _throttled.put(bucket, (window + 1) * period)
+        return False
+    return True
+
+
+def enforce(name, subject, calls, period, message=None):
+    """Counts a call as allow does, raising RateLimitExceededException if
+    it is over the limit"""
+    if not allow(name, subject, calls, period):
+        raise RateLimitExceededException(
+            message or 'Rate limit exceeded, try again shortly')
+
+
+def rate_limited(calls, period):
+    """Decorates an endpoint method whose request carries a
+    urlsafe_game_key, allowing each game at most calls per period (in
+    seconds) and raising RateLimitExceededException beyond that"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(service, request):
+            enforce(method.__name__, request.urlsafe_game_key, calls, period,
+                    'Rate limit exceeded for this game, try again shortly')
+            return method(service, request)
+        return wrapper
+    return decorator
@@ -1,35 +1,99 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
+import cache
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Recently decoded urlsafe key strings, and the keys they decode to
+_decoded_keys = cache.LRU(1000)
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string decodes to, checking
+        that it is of the expected kind. Decoded keys are memoized, since
+        the same key string is typically sent many times in a session
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The decoded key.
+    Raises:
+        BadRequestException: if the key String is malformed
+        ValueError: if the key is of the incorrect kind"""
+    key = _decoded_keys.get(urlsafe)
+    if key is None:
+        try:
+            key = ndb.Key(urlsafe=urlsafe)
+        except TypeError:
+            raise endpoints.BadRequestException('Invalid Key')
+        except Exception, e:
+            if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+                raise endpoints.BadRequestException('Invalid Key')
+            else:
+                raise
+        _decoded_keys.put(urlsafe, key)
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+
+def get_by_urlsafe_async(urlsafe, model, use_cache=False):
+    """Asynchronous version of get_by_urlsafe, returning a Future. Key
+        decoding errors are still raised immediately"""
+    key = get_key_by_urlsafe(urlsafe, model)
+    return cache.get_async(key) if use_cache else key.get_async()
+
+
+def get_by_urlsafe(urlsafe, model, use_cache=False):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+        that the key is of the correct kind before fetching anything. Raises
+        an error if the key String is malformed or the entity is of the
+        incorrect kind
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
+        use_cache: Return the entity straight from the write-through entity
+            cache when it is there
     Returns:
         The entity that the urlsafe Key string points to or None if no entity
         exists.
     Raises:
         ValueError:"""
+    return get_by_urlsafe_async(urlsafe, model, use_cache).get_result()
+
+
+@ndb.tasklet
+def fetch_page_async(query, request, **kwargs):
+    """Fetches one page of query results, as requested by the limit and
+    cursor fields of a paged request.
+    Args:
+        query: The ndb query to page through
+        request: A request carrying limit and (urlsafe) cursor fields
+        kwargs: Additional query options, e.g. projection
+    Returns:
+        A (results, next_cursor) tuple. next_cursor is the urlsafe cursor
+        of the following page, or None if this is the last page.
+    Raises:
+        BadRequestException: if the cursor is malformed"""
     try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception, e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
+        cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+    except (datastore_errors.BadValueError, TypeError):
+        raise endpoints.BadRequestException('Invalid cursor')
+    limit = min(max(request.limit or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    results, next_cursor, more = yield query.fetch_page_async(
+        limit, start_cursor=cursor, **kwargs)
+    if more and next_cursor:
+        raise ndb.Return(results, next_cursor.urlsafe())
+    raise ndb.Return(results, None)
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+
+def fetch_page(query, request, **kwargs):
+    """Synchronous version of fetch_page_async"""
+    return fetch_page_async(query, request, **kwargs).get_result()